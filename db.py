@@ -0,0 +1,211 @@
+from sqlalchemy import create_engine, bindparam, lambda_stmt, select, Column, Index, Integer, String, ForeignKey, func
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
+from sqlalchemy.types import DateTime
+from dotenv import load_dotenv
+from typing import Dict, List, Optional
+from collections import OrderedDict
+from contextvars import ContextVar
+import json
+import os
+import redis
+import threading
+import time
+
+# .env ファイルの読み込み
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL") # 環境変数から DATABASE_URL を取得
+
+# 接続プールはワーカープロセスごとに作られる。
+# MySQL への最大接続数は (POOL_SIZE + MAX_OVERFLOW) × WEB_CONCURRENCY × インスタンス数になるため、
+# max_connections を超えないように調整すること。
+POOL_SIZE = 10  # 常時保持する接続数
+MAX_OVERFLOW = 20  # 混雑時に一時的に追加できる接続数
+
+# SQLAlchemyの設定（utf8mb4を設定しない）
+# SQL ログは SQL_ECHO=1 のときだけ出力する
+engine = create_engine(
+    DATABASE_URL,
+    echo=os.getenv("SQL_ECHO") == "1",
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=30,  # 接続の空き待ち（秒）
+    pool_recycle=1800,  # 古い接続を作り直す間隔（秒）。Azure MySQL の wait_timeout より短くする
+    pool_pre_ping=True,  # 切断済みの接続を使う前に検知する
+)
+# リクエストごとのスコープ（main.py のミドルウェアで設定し、セッションのキーに使う）
+request_scope: ContextVar[Optional[object]] = ContextVar("request_scope", default=None)
+
+def _session_scope():
+    # リクエスト外（スクリプトやバックグラウンド処理）ではスレッドごとにセッションを分ける
+    scope = request_scope.get()
+    return scope if scope is not None else threading.get_ident()
+
+SessionLocal = scoped_session(
+    sessionmaker(autocommit=False, autoflush=False, bind=engine),
+    scopefunc=_session_scope,
+)
+Base = declarative_base()
+
+# DBモデル定義（商品マスター）
+class Product(Base):
+    __tablename__ = "m_product_okabe"
+
+    PRD_ID = Column(Integer, primary_key=True, index=True, autoincrement=True)  # 商品識別ID
+    CODE = Column(String(13), unique=True, index=True, nullable=False)  # 商品コード
+    NAME = Column(String(50), nullable=False)  # 商品名称
+    PRICE = Column(Integer, nullable=False)  # 商品単価
+
+    # 商品コード検索をインデックスだけで完結させるカバリングインデックス（PRD_ID は主キーとして含まれる）
+    __table_args__ = (
+        Index("ix_product_code_cover", "CODE", "NAME", "PRICE"),
+    )
+
+# DBモデル定義（取引）
+class Transaction(Base):
+    __tablename__ = "transactions_okabe"
+
+    TRD_ID = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    DATETIME = Column(DateTime, nullable=False, server_default=func.now())
+    EMP_CD = Column(String, nullable=False)
+    STORE_CD = Column(String, nullable=False)
+    POS_NO = Column(String, nullable=False)
+    TOTAL_AMT = Column(Integer, nullable=False)
+
+# DBモデル定義（取引明細）
+class TransactionDetail(Base):
+    __tablename__ = "transaction_details_okabe"
+
+    DTL_ID = Column(Integer, primary_key=True, autoincrement=True)
+    TRD_ID = Column(Integer, ForeignKey("transactions_okabe.TRD_ID"), nullable=False)
+    PRD_ID = Column(Integer, ForeignKey("m_product_okabe.PRD_ID"), nullable=False)
+    PRD_CODE = Column(String(13), nullable=False)
+    PRD_NAME = Column(String(50), nullable=False)
+    PRD_PRICE = Column(Integer, nullable=False)
+
+# DBセッションを取得する依存関係
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        SessionLocal.remove()  # セッションを閉じてスコープから外す
+
+# 商品コードで商品を取得するクエリ（モジュール読み込み時に一度だけ組み立て、コンパイル結果を再利用する）
+# 必要な列だけを取得し、ORM オブジェクトの生成を省く
+PRODUCTS_BY_CODE = lambda_stmt(
+    lambda: select(Product.PRD_ID, Product.CODE, Product.NAME, Product.PRICE)
+    .where(Product.CODE.in_(bindparam("codes", expanding=True)))
+)
+
+# 商品マスターのキャッシュ（プロセス内 LRU → Redis → DB の順に参照）
+# 商品マスターを更新しても、他のワーカー／インスタンスのプロセス内キャッシュは TTL まで残る。
+# invalidate_product_cache() を呼んだ場合の古い価格の残存は最大 PRODUCT_LOCAL_TTL 秒、
+# 呼ばずに DB を直接更新した場合は最大 PRODUCT_CACHE_TTL + PRODUCT_LOCAL_TTL 秒になる。
+PRODUCT_CACHE_SIZE = 1024  # プロセス内に保持する商品数
+PRODUCT_CACHE_TTL = 300  # Redis キャッシュの有効期間（秒）
+PRODUCT_LOCAL_TTL = 30  # プロセス内キャッシュの有効期間（秒）
+
+PRODUCT_FIELDS = ("PRD_ID", "CODE", "NAME", "PRICE")  # キャッシュする商品の項目
+
+_product_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_product_cache_lock = threading.Lock()
+
+# REDIS_URL が未設定ならプロセス内キャッシュのみ使う
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT = 0.2  # Redis の接続・応答待ち（秒）。超えたら DB にフォールバックする
+redis_client = (
+    redis.Redis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+    if REDIS_URL
+    else None
+)
+
+def _product_key(code: str) -> str:
+    return f"prd:{code}"
+
+def _local_get(code: str) -> Optional[dict]:
+    with _product_cache_lock:
+        entry = _product_cache.get(code)
+        if entry is None:
+            return None
+        expires_at, product = entry
+        if expires_at < time.monotonic():
+            del _product_cache[code]
+            return None
+        _product_cache.move_to_end(code)
+        return product
+
+def _local_set(code: str, product: dict):
+    with _product_cache_lock:
+        _product_cache[code] = (time.monotonic() + PRODUCT_LOCAL_TTL, product)
+        _product_cache.move_to_end(code)
+        while len(_product_cache) > PRODUCT_CACHE_SIZE:
+            _product_cache.popitem(last=False)
+
+def get_products_cached(db: Session, codes: List[str]) -> Dict[str, dict]:
+    """商品コードごとの {PRD_ID, CODE, NAME, PRICE} を返す（存在しないコードは含まない）"""
+    found = {}
+    misses = []
+    for code in dict.fromkeys(codes):
+        product = _local_get(code)
+        if product is None:
+            misses.append(code)
+        else:
+            found[code] = product
+
+    if misses and redis_client is not None:
+        try:
+            cached = redis_client.mget([_product_key(code) for code in misses])
+        except redis.RedisError:
+            cached = [None] * len(misses)
+        remaining = []
+        for code, raw in zip(misses, cached):
+            if raw is None:
+                remaining.append(code)
+                continue
+            try:
+                product = json.loads(raw)
+            except ValueError:
+                product = None
+            # 壊れた値や別形式の値はキャッシュミスとして DB から取り直す
+            if not isinstance(product, dict) or any(field not in product for field in PRODUCT_FIELDS):
+                remaining.append(code)
+                continue
+            _local_set(code, product)
+            found[code] = product
+        misses = remaining
+
+    if misses:
+        rows = db.execute(PRODUCTS_BY_CODE, {"codes": misses}).all()
+        for row in rows:
+            product = row._asdict()
+            _local_set(row.CODE, product)
+            found[row.CODE] = product
+        if rows and redis_client is not None:
+            try:
+                with redis_client.pipeline(transaction=False) as pipe:
+                    for row in rows:
+                        pipe.setex(_product_key(row.CODE), PRODUCT_CACHE_TTL, json.dumps(found[row.CODE]))
+                    pipe.execute()
+            except redis.RedisError:
+                pass
+
+    return found
+
+def get_product_cached(db: Session, code: str) -> Optional[dict]:
+    return get_products_cached(db, [code]).get(code)
+
+def invalidate_product_cache(code: str):
+    """商品マスターを更新したときに呼び出してキャッシュを破棄する
+
+    破棄できるのは Redis と呼び出したプロセスのキャッシュのみ。
+    他のプロセスは PRODUCT_LOCAL_TTL 秒以内に Redis／DB から取り直す。
+    """
+    with _product_cache_lock:
+        _product_cache.pop(code, None)
+    if redis_client is not None:
+        try:
+            redis_client.delete(_product_key(code))
+        except redis.RedisError:
+            pass
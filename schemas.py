@@ -0,0 +1,24 @@
+from pydantic import BaseModel
+from typing import List
+
+# Pydantic モデル定義
+class PurchaseItem(BaseModel):
+    code: str
+    prd_name: str
+    price: int
+
+class PurchaseRequest(BaseModel):
+    emp_cd: str
+    store_cd: str
+    pos_no: str
+    items: List[PurchaseItem]
+
+# レスポンスモデル定義（FastAPI が Pydantic で直接 JSON にシリアライズする）
+class ProductResponse(BaseModel):
+    CODE: str
+    NAME: str
+    PRICE: int
+
+class PurchaseResponse(BaseModel):
+    success: bool
+    total_amount: int